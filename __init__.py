@@ -11,7 +11,7 @@ bl_info = {
 }
 
 import bpy
-from . operators.face_model_loader import BrowseFaceModel, ICTFaceKitPanel
+from . operators.face_model_loader import BrowseFaceModel, ICTFaceKitPanel, resolve_obj_importer
 
 classes = (
     BrowseFaceModel,
@@ -19,9 +19,8 @@ classes = (
 )
 
 def register():
-    # Ensure OBJ importer is enabled
-    if not hasattr(bpy.ops.import_scene, 'obj'):
-        bpy.ops.preferences.addon_enable(module="io_scene_obj")
+    # Ensure OBJ importer is enabled and cached
+    resolve_obj_importer()
     
     for cls in classes:
         bpy.utils.register_class(cls)
@@ -1,38 +1,140 @@
 # operators/face_model_loader.py
 import os
+import re
 import json
-import itertools
 import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# orjson is optional; its JSONDecodeError subclasses json.JSONDecodeError
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 import bpy
 from bpy.props import StringProperty, BoolProperty
 from bpy_extras.io_utils import ImportHelper
 from bpy.types import Operator
 
-# Setup logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def import_obj(filepath):
-    """Import OBJ file using the appropriate operator based on Blender version"""
-    logger.debug(f"Attempting to import OBJ: {filepath}")
+# OBJ import operator for this Blender version, resolved once per session
+_obj_importer = None
+
+def resolve_obj_importer():
+    """Find and cache the OBJ import operator based on Blender version"""
+    global _obj_importer
+    if _obj_importer is not None:
+        return _obj_importer
     
     # Try the new Blender 4.x operator first
     if hasattr(bpy.ops.wm, 'obj_import'):
         logger.debug("Using Blender 4.x OBJ importer")
-        return bpy.ops.wm.obj_import(filepath=filepath)
+        _obj_importer = bpy.ops.wm.obj_import
+        return _obj_importer
     
-    # Fall back to the old operator for older versions
-    elif hasattr(bpy.ops.import_scene, 'obj'):
+    # Fall back to the old operator for older versions, enabling its addon if needed
+    if not hasattr(bpy.ops.import_scene, 'obj'):
+        bpy.ops.preferences.addon_enable(module="io_scene_obj")
+    if hasattr(bpy.ops.import_scene, 'obj'):
         logger.debug("Using legacy OBJ importer")
-        return bpy.ops.import_scene.obj(filepath=filepath)
+        # Splitting renumbers vertices, which would misalign the shape keys parsed from the raw files
+        _obj_importer = partial(bpy.ops.import_scene.obj, split_mode='OFF')
     
-    else:
+    return _obj_importer
+
+def import_obj(filepath):
+    """Import OBJ file using the cached operator for this Blender version"""
+    logger.debug("Attempting to import OBJ: %s", filepath)
+    
+    importer = _obj_importer or resolve_obj_importer()
+    if importer is None:
         raise ImportError("No OBJ importer found in Blender")
+    return importer(filepath=filepath)
+
+# Data of OBJ vertex position lines, without the leading keyword
+_OBJ_VERTEX_LINES = re.compile(rb'(?m)^v ([^\n]+)')
 
-def loadICTFaceModel(folderpath):
-    logger.info(f"Starting model load from directory: {folderpath}")
-    logger.debug(f"Current working directory: {os.getcwd()}")
+def _parse_obj_positions(filepath):
+    """Parse only the vertex positions (Nx3 float32) from an OBJ file"""
+    # read() releases the GIL while waiting on disk, so worker threads overlap their I/O
+    with open(filepath, 'rb') as objContent:
+        data = objContent.read()
+    
+    vertex_lines = _OBJ_VERTEX_LINES.findall(data)
+    if not vertex_lines:
+        return np.empty((0, 3), dtype=np.float32)
+    
+    # Lines may carry a w component or vertex colors after the position
+    values = np.fromstring(b' '.join(vertex_lines), dtype=np.float32, sep=' ')
+    return np.ascontiguousarray(values.reshape(len(vertex_lines), -1)[:, :3])
+
+def shape_key_deltas(obj, dtype=np.float16):
+    """Return each shape key's offset from the basis as an (N_shapes, N_verts, 3) array"""
+    num_vertices = len(obj.data.vertices)
+    shape_keys = obj.data.shape_keys
+    if shape_keys is None:
+        return np.empty((0, num_vertices, 3), dtype=dtype)
+    
+    reference_key = shape_keys.reference_key
+    basis = np.empty(num_vertices * 3, dtype=np.float32)
+    reference_key.data.foreach_get('co', basis)
+    
+    # Half precision by default to halve the size of the offsets
+    key_blocks = [key_block for key_block in shape_keys.key_blocks if key_block != reference_key]
+    deltas = np.empty((len(key_blocks), num_vertices * 3), dtype=dtype)
+    co = np.empty(num_vertices * 3, dtype=np.float32)
+    for i, key_block in enumerate(key_blocks):
+        key_block.data.foreach_get('co', co)
+        deltas[i] = co - basis
+    return deltas.reshape(len(key_blocks), num_vertices, 3)
+
+def shape_key_delta_texture(obj):
+    """Upload shape key deltas to a float GPU texture for evaluation in a shader
+    
+    Returns (texture, width, rows_per_shape); the offset of vertex v in shape i is
+    at texel (v % width, i * rows_per_shape + v // width).
+    """
+    import gpu
+    
+    deltas = shape_key_deltas(obj, dtype=np.float32)
+    num_shapes, num_vertices, _ = deltas.shape
+    if not num_vertices or not num_shapes:
+        raise ValueError(f"{obj.name} has no shape key deltas to upload")
+    
+    # Wrap each shape over several rows when it has more vertices than the texture is wide
+    max_size = gpu.capabilities.max_texture_size_get()
+    width = min(num_vertices, max_size)
+    rows_per_shape = -(-num_vertices // width)
+    if num_shapes * rows_per_shape > max_size:
+        raise ValueError(f"{num_shapes} shape keys of {num_vertices} vertices exceed the maximum GPU texture size of {max_size}")
+    texels = np.zeros((num_shapes, rows_per_shape * width, 4), dtype=np.float32)
+    texels[:, :num_vertices, :3] = deltas
+    
+    buffer = gpu.types.Buffer('FLOAT', texels.size, texels.ravel())
+    texture = gpu.types.GPUTexture((width, num_shapes * rows_per_shape), format='RGBA32F', data=buffer)
+    return texture, width, rows_per_shape
+
+def list_model_files(folderpath):
+    """Return the case-normalized names of the files in a face model directory"""
+    try:
+        return {os.path.normcase(entry.name) for entry in os.scandir(folderpath) if entry.is_file()}
+    except OSError as e:
+        logger.error("Invalid directory path: %s", folderpath)
+        raise ValueError(f"Invalid directory path: {folderpath}") from e
+
+def _model_file_exists(folderpath, entries, filename):
+    """Check a file against the directory listing, falling back to the filesystem on a miss"""
+    # normcase only folds case on Windows; the fallback covers other case-insensitive filesystems
+    return os.path.normcase(filename) in entries or os.path.exists(os.path.join(folderpath, filename))
+
+def loadICTFaceModel(folderpath, *, entries=None):
+    logger.info("Starting model load from directory: %s", folderpath)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Current working directory: %s", os.getcwd())
     
     # Define names to use
     face_model_name = "ICTFaceModel"
@@ -40,137 +142,151 @@ def loadICTFaceModel(folderpath):
     identity_morph_target_name = "identity{:03d}"
     config_filename = "vertex_indices.json"
     
-    # Verify folder path exists
-    logger.debug(f"Checking if directory exists: {folderpath}")
-    if not os.path.isdir(folderpath):
-        logger.error(f"Invalid directory path: {folderpath}")
-        raise ValueError(f"Invalid directory path: {folderpath}")
+    # List the directory once, unless the caller already did, so file checks below are set lookups
+    if entries is None:
+        entries = list_model_files(folderpath)
         
     # Specify paths
     generic_neutral_filepath = os.path.join(folderpath, generic_neutral_filename)
     config_filepath = os.path.join(folderpath, config_filename)
     
-    logger.debug(f"Neutral mesh path: {generic_neutral_filepath}")
-    logger.debug(f"Config file path: {config_filepath}")
+    logger.debug("Neutral mesh path: %s", generic_neutral_filepath)
+    logger.debug("Config file path: %s", config_filepath)
     
     # Verify required files exist
-    if not os.path.exists(generic_neutral_filepath):
-        logger.error(f"Cannot find neutral mesh: {generic_neutral_filepath}")
+    if not _model_file_exists(folderpath, entries, generic_neutral_filename):
+        logger.error("Cannot find neutral mesh: %s", generic_neutral_filepath)
         raise FileNotFoundError(f"Cannot find neutral mesh: {generic_neutral_filepath}")
-    if not os.path.exists(config_filepath):
-        logger.error(f"Cannot find config file: {config_filepath}")
+    if not _model_file_exists(folderpath, entries, config_filename):
+        logger.error("Cannot find config file: %s", config_filepath)
         raise FileNotFoundError(f"Cannot find config file: {config_filepath}")
     
     # Load settings
     try:
-        with open(config_filepath) as jsonContent:
-            config = json.load(jsonContent)    
+        with open(config_filepath, 'rb') as jsonContent:
+            config = json_loads(jsonContent.read())
         if not config:
             logger.error("Empty configuration file")
             raise ValueError("Empty configuration file")
-        logger.debug(f"Loaded config: {config}")
+        logger.debug("Loaded config: %s", config)
     except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON in config file: {config_filepath}")
-        logger.error(f"JSON error: {str(e)}")
+        logger.error("Invalid JSON in config file: %s", config_filepath)
+        logger.error("JSON error: %s", e)
         raise ValueError(f"Invalid JSON in config file: {config_filepath}")
     
+    # Collect every morph target file upfront so no filesystem checks are
+    # interleaved with importing
+    join = os.path.join
+    morph_targets = [None] * len(config['expressions'])
+    num_found = 0
+    for expression_name in config['expressions']:
+        filename = expression_name + '.obj'
+        filepath = join(folderpath, filename)
+        if not _model_file_exists(folderpath, entries, filename):
+            logger.warning("Expression morph target not found: %s", filepath)
+            continue
+        morph_targets[num_found] = ('expression', expression_name, filepath)
+        num_found += 1
+    del morph_targets[num_found:]
+    
+    identity_num = 0
+    while True:
+        identity_name = identity_morph_target_name.format(identity_num)
+        filename = identity_name + ".obj"
+        if not _model_file_exists(folderpath, entries, filename):
+            if identity_num == 0:
+                logger.info("No identity morph targets found")
+            else:
+                logger.info("No more identity morph targets found after %d", identity_num - 1)
+            break
+        morph_targets.append(('identity', identity_name, join(folderpath, filename)))
+        identity_num += 1
+    
+    view_layer = bpy.context.view_layer
+    
     # Load generic neutral
     try:
-        logger.info(f"Attempting to import neutral mesh: {generic_neutral_filepath}")
+        logger.info("Attempting to import neutral mesh: %s", generic_neutral_filepath)
         
-        # Import the neutral mesh
+        # Import the neutral mesh, finding it by set difference rather than selection
+        known_objects = set(bpy.data.objects.keys())
         import_result = import_obj(generic_neutral_filepath)
-        logger.debug(f"Import result: {import_result}")
+        logger.debug("Import result: %s", import_result)
         
-        if not bpy.context.selected_objects:
-            logger.error("No objects selected after import")
+        new_objects = set(bpy.data.objects.keys()) - known_objects
+        if not new_objects:
+            logger.error("No objects created by import")
             raise ImportError("Failed to import neutral mesh")
             
-        face_model_neutral_object = bpy.context.selected_objects[0]
+        face_model_neutral_object = bpy.data.objects[new_objects.pop()]
         face_model_neutral_object.name = face_model_name
         logger.info("Successfully imported neutral mesh")
         
     except Exception as e:
-        logger.error(f"Error importing neutral mesh: {str(e)}")
+        logger.error("Error importing neutral mesh: %s", e)
         logger.error("Import error details:", exc_info=True)
         raise ImportError(f"Error importing neutral mesh: {str(e)}")
     
-    # Load expression morph targets
-    expression_names = []
-    expression_models = []
-    for expression_name in config['expressions']:
-        filename = expression_name + '.obj'
-        filepath = os.path.join(folderpath, filename)
-        if not os.path.exists(filepath):
-            logger.warning(f"Expression morph target not found: {filepath}")
-            continue
-            
-        try:
-            logger.info(f"Reading expression morph target: {expression_name}")
-            import_obj(filepath)
-            
-            if not bpy.context.selected_objects:
-                logger.warning(f"Failed to import expression {expression_name}")
-                continue
-                
-            imported_object = bpy.context.selected_objects[0]
-            imported_object.name = expression_name
-        
-            expression_names.append(expression_name)
-            expression_models.append(imported_object)
-        except Exception as e:
-            logger.error(f"Error importing expression {expression_name}: {str(e)}")
-            continue
+    # Morph targets share the neutral topology, so only their positions are parsed
+    # and written straight into shape keys on the neutral object
+    num_vertices = len(face_model_neutral_object.data.vertices)
     
-    identity_names = []
-    identity_models = []
-    # Load identity morph targets
-    for identity_num in itertools.count():
-        identity_name = identity_morph_target_name.format(identity_num)
-        identity_filename = identity_name + ".obj"
-        filepath = os.path.join(folderpath, identity_filename)
+    # Shape keys are written in raw file order, so the importer must have kept it
+    try:
+        file_positions = _parse_obj_positions(generic_neutral_filepath)
+        if len(file_positions) != num_vertices:
+            raise ImportError(f"Imported neutral mesh has {num_vertices} vertices but the OBJ file has {len(file_positions)}")
         
-        if not os.path.exists(filepath):
-            if identity_num == 0:
-                logger.info("No identity morph targets found")
-            else:
-                logger.info(f"No more identity morph targets found after {identity_num-1}")
-            break
-            
-        try:
-            logger.info(f"Reading identity morph target: {identity_name}")
-            import_obj(filepath)
-            
-            if not bpy.context.selected_objects:
-                logger.warning(f"Failed to import identity {identity_name}")
-                continue
+        neutral_positions = np.empty(num_vertices * 3, dtype=np.float32)
+        face_model_neutral_object.data.vertices.foreach_get('co', neutral_positions)
+        if not np.allclose(neutral_positions, file_positions.ravel(), atol=1e-6):
+            raise ImportError("Imported neutral mesh vertex order differs from the OBJ file")
+    except Exception as e:
+        logger.error("Neutral mesh doesn't match %s: %s", generic_neutral_filepath, e)
+        # Don't leave a model without shape keys behind in the scene
+        neutral_mesh = face_model_neutral_object.data
+        bpy.data.objects.remove(face_model_neutral_object, do_unlink=True)
+        bpy.data.meshes.remove(neutral_mesh)
+        raise
+    face_model_neutral_object.shape_key_add(name="Basis", from_mix=False)
+    
+    # Load expression and identity morph targets. Files are read and parsed
+    # on worker threads; shape keys are written on this thread as bpy isn't thread-safe.
+    num_expressions = 0
+    num_identities = 0
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        parsed_morph_targets = [
+            (kind, morph_name, executor.submit(_parse_obj_positions, filepath))
+            for kind, morph_name, filepath in morph_targets
+        ]
+        for kind, morph_name, parsed in parsed_morph_targets:
+            try:
+                logger.debug("Reading %s morph target: %s", kind, morph_name)
+                verts = parsed.result()
+                if len(verts) != num_vertices:
+                    raise ValueError(f"Expected {num_vertices} vertices, found {len(verts)}")
                 
-            imported_object = bpy.context.selected_objects[0]
-            imported_object.name = identity_name
-        
-            identity_names.append(identity_name)
-            identity_models.append(imported_object)
-        except Exception as e:
-            logger.error(f"Error loading identity morph target {identity_name}: {str(e)}")
-            break
+                # from_mix=False copies the basis instead of evaluating every existing key
+                shape_key = face_model_neutral_object.shape_key_add(name=morph_name, from_mix=False)
+                shape_key.data.foreach_set('co', verts.ravel())
+                
+                if kind == 'expression':
+                    num_expressions += 1
+                else:
+                    num_identities += 1
+            except Exception as e:
+                logger.error("Error importing %s %s: %s", kind, morph_name, e)
+                continue
     
-    if not expression_models and not identity_models:
+    if not num_expressions and not num_identities:
         raise ValueError("No valid morph targets found in directory")
     
-    # Select all shape models
-    for expression_model in expression_models:
-        expression_model.select_set(True)
-    for identity_model in identity_models:
-        identity_model.select_set(True)
-    bpy.context.view_layer.objects.active = face_model_neutral_object
-   
-    # Create blendshapes
-    bpy.ops.object.join_shapes()
-
-    # Delete selected shape objects
-    bpy.ops.object.delete()
+    # Shape key writes don't tag anything for update, so refresh once after all of them
+    face_model_neutral_object.data.update()
+    view_layer.objects.active = face_model_neutral_object
+    view_layer.update()
     
-    return len(expression_models), len(identity_models)
+    return num_expressions, num_identities
 
 
 class BrowseFaceModel(Operator, ImportHelper):
@@ -193,17 +309,17 @@ class BrowseFaceModel(Operator, ImportHelper):
     def execute(self, context):
         try:
             # Log the filepath and directory
-            logger.info(f"Selected filepath: {self.filepath}")
+            logger.info("Selected filepath: %s", self.filepath)
             directory = os.path.dirname(self.filepath)
-            logger.info(f"Extracted directory: {directory}")
+            logger.info("Extracted directory: %s", directory)
             
-            # Check if directory exists
-            logger.debug(f"Directory exists: {os.path.exists(directory)}")
-            logger.debug(f"Is directory: {os.path.isdir(directory)}")
+            # List the directory once; this also fails early if it doesn't exist
+            entries = list_model_files(directory)
+            logger.debug("Directory contains %d files", len(entries))
             
             # Try to load the model
-            num_expressions, num_identities = loadICTFaceModel(directory)
-            logger.info(f"Successfully loaded {num_expressions} expressions and {num_identities} identities")
+            num_expressions, num_identities = loadICTFaceModel(directory, entries=entries)
+            logger.info("Successfully loaded %d expressions and %d identities", num_expressions, num_identities)
             self.report({'INFO'}, f"Face model loaded successfully with {num_expressions} expressions and {num_identities} identities")
             
         except Exception as e: